@@ -1,18 +1,152 @@
 import asyncio
+import hashlib
+import os
+import re
 import sys
+import time
 import logging
-from typing import Any
+import multiprocessing
+from collections import OrderedDict
+from typing import Any, Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 
+from mcp.client.sse import sse_client
 from mcp.client.stdio import stdio_client, StdioServerParameters
 from mcp import ClientSession
 
 import main_client
 
 logger = logging.getLogger("mssql_mcp_api")
-app = FastAPI(title="MSSQL MCP API")
+# orjson serializes large result texts much faster than the stdlib encoder
+app = FastAPI(title="MSSQL MCP API", default_response_class=ORJSONResponse)
+
+# schema changes rarely, so keep the get_schema result around instead of
+# doing a stdio round-trip on every request
+SCHEMA_TTL = 300
+SHUTDOWN_TIMEOUT = 5.0
+# With several Uvicorn workers, point them all at one shared server.py
+# (`python server.py --transport sse`) instead of each spawning its own.
+MCP_SERVER_URL = os.getenv("MCP_SERVER_URL")
+app.state.schema_cache = {"text": None, "expires": 0}
+# /query results come from the live database, so they are only reused briefly
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "60"))
+QUERY_CACHE_MAXSIZE = 256
+
+
+class QueryCache:
+    """Two-layer cache for full /query results.
+
+    L1 is keyed by sha256(prompt + schema_hash) for exact repeats. On an L1 miss,
+    L2 looks for a semantically similar earlier prompt (when the semantic
+    backend is available) and backfills L1 on a hit. Entries hold live query
+    results, so they expire after `ttl` seconds; at most `maxsize` are kept (LRU).
+    """
+
+    def __init__(
+        self,
+        threshold: float = main_client.SEMANTIC_THRESHOLD,
+        ttl: float = QUERY_CACHE_TTL,
+        maxsize: int = QUERY_CACHE_MAXSIZE,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._index = None
+        self._keys: list[str] = []
+        self._schema_hash: Optional[str] = None
+
+    @staticmethod
+    def schema_hash(schema_text: str) -> str:
+        return hashlib.sha256(schema_text.encode()).hexdigest()
+
+    @staticmethod
+    def key(prompt: str, schema_hash: str) -> str:
+        return hashlib.sha256((prompt + schema_hash).encode()).hexdigest()
+
+    def clear(self):
+        self.entries.clear()
+        self._index = None
+        self._keys = []
+        self._schema_hash = None
+
+    def _reset_if_schema_changed(self, schema_hash: str):
+        if self._schema_hash != schema_hash:
+            self.clear()
+            self._index = main_client.new_semantic_index() if main_client.semantic_enabled() else None
+            self._schema_hash = schema_hash
+
+    def _live(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["ts"] > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def _store(self, key: str, entry: dict):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def _rebuild_index(self):
+        # the flat index can't drop single vectors, so once evicted/expired
+        # entries dominate it, rebuild it from the live ones
+        self._index = main_client.new_semantic_index()
+        self._keys = []
+        seen = set()
+        for key, entry in self.entries.items():
+            if id(entry) in seen or entry.get("emb") is None:
+                continue
+            seen.add(id(entry))
+            self._index.add(entry["emb"])
+            self._keys.append(key)
+
+    def get(self, prompt: str, schema_hash: str, emb=None) -> tuple[Optional[dict], Optional[str]]:
+        """Return (entry, layer) where layer is "L1", "L2" or None on miss.
+
+        `emb` is the prompt embedding if the caller already computed it.
+        """
+        self._reset_if_schema_changed(schema_hash)
+        k1 = self.key(prompt, schema_hash)
+        entry = self._live(k1)
+        if entry is not None:
+            return entry, "L1"
+        if self._index is None or self._index.ntotal == 0:
+            return None, None
+        if emb is None:
+            emb = main_client.embed_prompt(prompt)
+        D, I = self._index.search(emb, 1)
+        if D[0, 0] >= self.threshold:
+            entry = self._live(self._keys[I[0, 0]])
+            if entry is not None:
+                self._store(k1, entry)
+                return entry, "L2"
+        return None, None
+
+    def set(self, prompt: str, schema_hash: str, sql: str, result: str, row_count: int, summary: str, emb=None):
+        self._reset_if_schema_changed(schema_hash)
+        k1 = self.key(prompt, schema_hash)
+        if self._index is not None and emb is None:
+            emb = main_client.embed_prompt(prompt)
+        self._store(k1, {
+            "sql": sql, "result": result, "row_count": row_count, "summary": summary,
+            "emb": emb, "ts": time.monotonic(),
+        })
+        if self._index is not None:
+            self._index.add(emb)
+            self._keys.append(k1)
+            if self._index.ntotal > 2 * self.maxsize:
+                self._rebuild_index()
+
+
+app.state.query_cache = QueryCache()
 
 
 class NLRequest(BaseModel):
@@ -25,13 +159,18 @@ class SQLRequest(BaseModel):
 
 @app.on_event("startup")
 async def startup():
-    """Start MCP stdio client and initialize ClientSession."""
+    """Start the MCP client (SSE if MCP_SERVER_URL is set, else stdio) and initialize ClientSession."""
     # Use same server params as main_client's main() (simple and explicit)
     server_params = StdioServerParameters(command=sys.executable, args=["server.py"])
 
+    def _transport():
+        if MCP_SERVER_URL:
+            return sse_client(MCP_SERVER_URL)
+        return stdio_client(server_params)
+
     async def _client_runner():
         try:
-            async with stdio_client(server_params) as (read, write):
+            async with _transport() as (read, write):
                 async with ClientSession(read, write) as session:
                     await session.initialize()
                     app.state.session = session
@@ -46,17 +185,51 @@ async def startup():
             app.state.startup_error = str(e)
 
     app.state._client_task = asyncio.create_task(_client_runner())
+    main_client.load_semantic_cache()
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    """Cancel the MCP client runner and wait for stdio_client to exit.
+
+    stdio_client terminates the server.py child when its context exits, so the
+    runner has to actually get through its cleanup; otherwise the child is
+    leaked across (dev) reloads.
+    """
     task = getattr(app.state, "_client_task", None)
     if task:
         task.cancel()
         try:
-            await task
-        except Exception:
+            await asyncio.wait_for(asyncio.shield(task), timeout=SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("MCP client runner did not stop within %ss; server.py may still be running", SHUTDOWN_TIMEOUT)
+        except asyncio.CancelledError:
             pass
+        except Exception:
+            logger.exception("MCP client runner failed during shutdown")
+    app.state.session = None
+    # with --workers every worker would write the same files; only a
+    # single-process server persists the semantic cache
+    if multiprocessing.parent_process() is None:
+        main_client.save_semantic_cache()
+    else:
+        logger.info("Running as a worker process; not saving the semantic cache")
+
+
+async def _get_schema_cached(session: ClientSession, ttl: float = SCHEMA_TTL) -> str:
+    """Return schema text, calling the get_schema tool only when the cache expired."""
+    cache = app.state.schema_cache
+    if cache["text"] is not None and time.monotonic() < cache["expires"]:
+        return cache["text"]
+
+    # concurrent misses share the one in-flight get_schema call
+    res = await main_client.call_tool_coalesced(session, "get_schema", {})
+    text = res.content[0].text
+    # don't cache failures reported by the server
+    if not text.startswith("Error"):
+        cache["text"] = text
+        cache["expires"] = time.monotonic() + ttl
+    return text
 
 
 def _get_session() -> ClientSession:
@@ -70,33 +243,54 @@ def _get_session() -> ClientSession:
 
 @app.get("/health")
 async def health() -> Any:
-    return {"api": "ok", "mcp_session": bool(getattr(app.state, "session", None)), "startup_error": getattr(app.state, "startup_error", None)}
+    return {
+        "api": "ok",
+        "mcp_session": bool(getattr(app.state, "session", None)),
+        "startup_error": getattr(app.state, "startup_error", None),
+        "llm_cache": main_client.cache_stats(),
+        "intent_hits": main_client.intent_hits(),
+    }
 
 
 @app.get("/schema")
 async def get_schema() -> Any:
     session = _get_session()
     try:
-        res = await session.call_tool("get_schema", arguments={})
-        return {"schema": res.content[0].text}
+        return {"schema": await _get_schema_cached(session)}
     except Exception as e:
         logger.exception("schema error")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/schema/invalidate")
+async def invalidate_schema() -> Any:
+    app.state.schema_cache["expires"] = 0
+    app.state.query_cache.clear()
+    return {"invalidated": True}
+
+
+@app.post("/cache/clear")
+async def clear_cache() -> Any:
+    await main_client.get_cache().clear()
+    main_client.clear_semantic_cache()
+    app.state.query_cache.clear()
+    return {"cleared": True}
+
+
 @app.post("/nl2sql")
 async def nl2sql(req: NLRequest) -> Any:
     # provide schema context if available
     session = _get_session()
     try:
-        schema_res = await session.call_tool("get_schema", arguments={})
-        schema_text = schema_res.content[0].text
+        schema_text = await _get_schema_cached(session)
     except Exception:
         schema_text = ""
 
     try:
         sql = await main_client.nl_to_sql(req.prompt, schema_text)
         return {"sql": sql}
+    except main_client.SQLValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.exception("nl2sql failed")
         raise HTTPException(status_code=500, detail=str(e))
@@ -114,18 +308,30 @@ async def execute(req: SQLRequest) -> Any:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/query")
-async def query(req: NLRequest) -> Any:
-    session = _get_session()
-    # get schema
-    try:
-        schema_res = await session.call_tool("get_schema", arguments={})
-        schema_text = schema_res.content[0].text
-    except Exception:
-        schema_text = ""
+async def _schema_and_embedding(session: ClientSession, prompt: str):
+    """Fetch the schema and, if the semantic cache is on, embed the prompt."""
+
+    async def _schema_or_empty() -> str:
+        try:
+            return await _get_schema_cached(session)
+        except Exception:
+            return ""
 
+    # the stdio round-trip doesn't depend on the prompt, so it runs alongside
+    # the (CPU-bound) prompt embedding instead of before it
+    if main_client.semantic_enabled():
+        return await asyncio.gather(
+            _schema_or_empty(), asyncio.to_thread(main_client.embed_prompt, prompt)
+        )
+    return await _schema_or_empty(), None
+
+
+async def _generate_and_execute(session: ClientSession, prompt: str, schema_text: str, emb):
+    """NL -> SQL -> execute; returns (sql, exec_text)."""
     try:
-        sql = await main_client.nl_to_sql(req.prompt, schema_text)
+        sql = await main_client.nl_to_sql(prompt, schema_text, emb=emb)
+    except main_client.SQLValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.exception("nl_to_sql failed")
         raise HTTPException(status_code=500, detail=str(e))
@@ -137,12 +343,105 @@ async def query(req: NLRequest) -> Any:
         logger.exception("execute failed")
         raise HTTPException(status_code=500, detail=str(e))
 
+    return sql, exec_text
+
+
+def _summary_rows(header: list[str], rows: list[list[str]]) -> str:
+    # header + first 10 rows
+    return main_client.tabular_text(header, rows[:10])
+
+
+# SSE treats CRLF, a bare CR and a bare LF all as line breaks
+_SSE_LINE_RE = re.compile(r"\r\n|\r|\n")
+
+
+def _sse(data: str, event: Optional[str] = None) -> str:
+    """Format one Server-Sent Event; multi-line data gets one `data:` line per line."""
+    head = f"event: {event}\n" if event else ""
+    return head + "".join(f"data: {line}\n" for line in _SSE_LINE_RE.split(data)) + "\n"
+
+
+@app.post("/query")
+async def query(req: NLRequest, response: Response) -> Any:
+    session = _get_session()
+    schema_text, emb = await _schema_and_embedding(session, req.prompt)
+
+    cache = app.state.query_cache
+    # without a real schema the cache is neither read nor written; hashing a
+    # failed fetch would look like a schema change and flush it
+    cacheable = main_client.schema_usable(schema_text)
+    schema_hash = cache.schema_hash(schema_text)
+    entry, layer = cache.get(req.prompt, schema_hash, emb) if cacheable else (None, None)
+    if entry is not None:
+        response.headers["X-Cache-Status"] = f"HIT-{layer}"
+        return {k: entry[k] for k in ("sql", "result", "row_count", "summary")}
+    response.headers["X-Cache-Status"] = "MISS" if cacheable else "BYPASS"
+
+    sql, exec_text = await _generate_and_execute(session, req.prompt, schema_text, emb)
+    # parse once; the summary prefix and row count both come from the parsed rows
+    header, rows = main_client.parse_tabular(exec_text)
+
     # summarise using main_client.summarise
     try:
-        lines = exec_text.splitlines()
-        rows_text = "\n".join(lines[:11]) if len(lines) > 11 else exec_text
-        summary = await main_client.summarise(req.prompt, sql, rows_text)
+        summary = await main_client.summarise(req.prompt, sql, _summary_rows(header, rows))
     except Exception:
         summary = "(summary failed)"
+    else:
+        # only cache pipelines that actually succeeded
+        if cacheable and not exec_text.startswith("Error"):
+            cache.set(req.prompt, schema_hash, sql, exec_text, len(rows), summary, emb)
+
+    return {"sql": sql, "result": exec_text, "row_count": len(rows), "summary": summary}
+
+
+@app.get("/query/stream")
+async def query_stream(prompt: str) -> StreamingResponse:
+    """Same pipeline as /query, streamed as Server-Sent Events.
+
+    Emits `sql`, `result` and `row_count` events, then the summary as unnamed `data` events
+    while Gemini produces it, and finally a `done` event.
+    """
+    session = _get_session()
+    schema_text, emb = await _schema_and_embedding(session, prompt)
+
+    cache = app.state.query_cache
+    cacheable = main_client.schema_usable(schema_text)
+    schema_hash = cache.schema_hash(schema_text)
+    entry, layer = cache.get(prompt, schema_hash, emb) if cacheable else (None, None)
+    if entry is not None:
+        headers = {"X-Cache-Status": f"HIT-{layer}"}
+    else:
+        headers = {"X-Cache-Status": "MISS" if cacheable else "BYPASS"}
+
+    if entry is not None:
+        async def _cached_events():
+            yield _sse(entry["sql"], "sql")
+            yield _sse(entry["result"], "result")
+            yield _sse(str(entry["row_count"]), "row_count")
+            yield _sse(entry["summary"])
+            yield _sse("", "done")
+
+        return StreamingResponse(_cached_events(), media_type="text/event-stream", headers=headers)
+
+    sql, exec_text = await _generate_and_execute(session, prompt, schema_text, emb)
+    header, rows = main_client.parse_tabular(exec_text)
+
+    async def _events():
+        yield _sse(sql, "sql")
+        yield _sse(exec_text, "result")
+        yield _sse(str(len(rows)), "row_count")
+        # accumulate chunks so the full summary can be cached once it completes
+        parts = []
+        try:
+            async for chunk in main_client.summarise_stream(prompt, sql, _summary_rows(header, rows)):
+                parts.append(chunk)
+                yield _sse(chunk)
+        except Exception:
+            logger.exception("summary stream failed")
+            yield _sse("(summary failed)", "error")
+        else:
+            if cacheable and not exec_text.startswith("Error"):
+                cache.set(prompt, schema_hash, sql, exec_text, len(rows), "".join(parts).strip(), emb)
+        yield _sse("", "done")
 
-    return {"sql": sql, "result": exec_text, "summary": summary}
+    return StreamingResponse(_events(), media_type="text/event-stream", headers=headers)
@@ -1,11 +1,58 @@
 import asyncio
+import datetime
+import hashlib
+import json
+import logging
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Protocol
+
 import google.generativeai as genai
+import orjson
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ParseError
+from google.api_core import exceptions as google_exceptions
+from google.generativeai import caching
 from dotenv import load_dotenv
 
 from mcp import ClientSession
 from mcp.client.stdio import stdio_client, StdioServerParameters
 
+# Semantic cache is optional: without these packages only exact matches are cached
+try:
+    import faiss
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    faiss = None
+    SentenceTransformer = None
+
+# Redis (shared cache) and zstd (value compression) are optional as well
+try:
+    import redis.asyncio as redis_asyncio
+    from redis.exceptions import RedisError
+except ImportError:
+    redis_asyncio = None
+    RedisError = OSError
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+# faster event loop, used when available
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+logger = logging.getLogger("mssql_mcp_client")
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -13,18 +60,17 @@ load_dotenv()
 # Gemini Setup 
 
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
-# function natural language to convert to sql query
-
-async def nl_to_sql(user_prompt: str, schema: str):
-    """Convert natural language to MSSQL query using Gemini."""
-    system_prompt = f"""
+MODEL_NAME = "gemini-2.5-flash"
+# built once and shared; the async API keeps the event loop free during the call
+_model = genai.GenerativeModel(MODEL_NAME)
+
+# NL -> SQL instructions never change, so they go first as the system
+# instruction; only schema + user request vary per call. Keeping the prefix
+# stable lets Gemini's implicit prompt caching reuse it.
+STATIC_SYSTEM = """
 Convert the user's request to a VALID MSSQL SQL query.
 Return ONLY the SQL query without any markdown formatting, explanations, or code blocks.
 
-Schema:
-{schema}
-
 Rules:
 - Use SELECT TOP N instead of LIMIT N
 - Do NOT use SHOW TABLES (use SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES instead)
@@ -32,27 +78,641 @@ Rules:
 - No markdown code blocks (no ```sql or ```)
 - No explanations or comments
 """
+_sql_model = genai.GenerativeModel(MODEL_NAME, system_instruction=STATIC_SYSTEM)
+# bump when prompt construction changes in a way STATIC_SYSTEM doesn't show
+# (e.g. schema compaction rules), to invalidate cached answers
+PROMPT_VERSION = 2
+
+# Schemas above this size are uploaded once as explicit CachedContent and the
+# handle is reused until the schema changes or the cache is about to expire
+# (~4 chars per token).
+SCHEMA_CACHE_MIN_TOKENS = 32_768
+SCHEMA_CACHE_TTL = datetime.timedelta(hours=1)
+SCHEMA_CACHE_REFRESH = datetime.timedelta(minutes=5)
+# schema hash -> (model, monotonic time after which a new cache is created, CachedContent)
+_schema_models: dict[str, tuple] = {}
+
+
+# Exact-match response cache 
+# Identical (model, prompt, schema) triples return the stored Gemini answer
+# instead of doing another round-trip. The cache goes through a CacheBackend so
+# it can live in-process (LocalBackend) or in Redis (RedisBackend), which
+# shares hits between Uvicorn workers and the Streamlit app.
+
+CACHE_MAXSIZE = 512
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_KEY_PREFIX = "mcp:sql:"
+_cache_stats = {"hits": 0, "misses": 0}
+_cache: Optional["CacheBackend"] = None
+
+
+class CacheBackend(Protocol):
+    async def get(self, key: str) -> Optional[str]: ...
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None: ...
+
+    async def delete(self, key: str) -> None: ...
+
+    async def clear(self) -> None: ...
+
+
+class LocalBackend:
+    """In-process LRU. Values are (text, expires) tuples, expires is None without a TTL."""
+
+    name = "local"
+
+    def __init__(self, maxsize: int = CACHE_MAXSIZE):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, tuple[str, Optional[float]]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and time.monotonic() >= expires:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        expires = time.monotonic() + ttl if ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def clear(self) -> None:
+        self._data.clear()
+
+
+class RedisBackend:
+    """Redis-backed cache, falling back to a LocalBackend while Redis is unreachable.
+
+    Values are stored as JSON, zstd-compressed when `zstandard` is installed.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, fallback: Optional[LocalBackend] = None):
+        self._redis = redis_asyncio.Redis.from_url(url, max_connections=20)
+        self.fallback = fallback or LocalBackend()
+
+    def __len__(self):
+        return len(self.fallback)
+
+    @staticmethod
+    def _encode(value: str) -> bytes:
+        data = orjson.dumps({"v": value})
+        return zstd.ZstdCompressor().compress(data) if zstd else data
+
+    @staticmethod
+    def _decode(data: bytes) -> str:
+        if data.startswith(_ZSTD_MAGIC):
+            data = zstd.ZstdDecompressor().decompress(data)
+        return orjson.loads(data)["v"]
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            data = await self._redis.get(REDIS_KEY_PREFIX + key)
+        except RedisError as e:
+            logger.warning("Redis get failed, using local cache: %s", e)
+            return await self.fallback.get(key)
+        if data is None or (data.startswith(_ZSTD_MAGIC) and zstd is None):
+            return None
+        return self._decode(data)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        try:
+            await self._redis.set(REDIS_KEY_PREFIX + key, self._encode(value), ex=int(ttl) if ttl else None)
+        except RedisError as e:
+            logger.warning("Redis set failed, using local cache: %s", e)
+            await self.fallback.set(key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await self.fallback.delete(key)
+        try:
+            await self._redis.delete(REDIS_KEY_PREFIX + key)
+        except RedisError as e:
+            logger.warning("Redis delete failed: %s", e)
 
-    response = genai.GenerativeModel("gemini-2.5-flash").generate_content(
-        system_prompt + "\n\nUser request: " + user_prompt
+    async def clear(self) -> None:
+        await self.fallback.clear()
+        try:
+            async for k in self._redis.scan_iter(match=REDIS_KEY_PREFIX + "*"):
+                await self._redis.delete(k)
+        except RedisError as e:
+            logger.warning("Redis clear failed: %s", e)
+
+
+def get_cache() -> CacheBackend:
+    """Shared response cache: Redis when REDIS_URL is set and redis is installed, else local LRU."""
+    global _cache
+    if _cache is None:
+        if REDIS_URL and redis_asyncio is not None:
+            _cache = RedisBackend(REDIS_URL)
+        else:
+            _cache = LocalBackend()
+    return _cache
+
+
+def _cache_key(prompt: str, schema: str = "", system: str = "") -> str:
+    # the system prompt and PROMPT_VERSION are part of the key, so answers
+    # produced under an older prompt (e.g. still in Redis) are not reused
+    payload = orjson.dumps(
+        {
+            "m": MODEL_NAME,
+            "v": PROMPT_VERSION,
+            "sys": hashlib.sha256(system.encode()).hexdigest(),
+            "p": prompt,
+            "s": schema,
+        },
+        option=orjson.OPT_SORT_KEYS,
     )
-    
-    sql = response.text.strip()
-    
-    # Clean up any markdown code blocks if present
-    if sql.startswith("```"):
-        lines = sql.split("\n")
-        # Remove first line (```sql) and last line (```)
-        sql = "\n".join(lines[1:-1]).strip() if len(lines) > 2 else sql
-        # Additional cleanup in case of inline ```
-        sql = sql.replace("```sql", "").replace("```", "").strip()
-    
+    return hashlib.sha256(payload).hexdigest()
+
+
+async def _cache_get(key: str) -> Optional[str]:
+    value = await get_cache().get(key)
+    _cache_stats["hits" if value is not None else "misses"] += 1
+    return value
+
+
+async def _cache_set(key: str, value: str, ttl: Optional[float] = None):
+    await get_cache().set(key, value, ttl)
+
+
+def cache_stats() -> dict:
+    """Hit/miss counters, backend name and local size of the response cache."""
+    cache = get_cache()
+    return {**_cache_stats, "backend": cache.name, "size": len(cache)}
+
+
+# Request coalescing 
+# Concurrent identical calls (the same get_schema, or the same prompt missing
+# the cache) share one in-flight call instead of each doing a round-trip.
+
+class SingleFlight:
+    """Run at most one call per key at a time; concurrent callers await the same result."""
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, coro_factory):
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(coro_factory())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield so one cancelled caller doesn't cancel the call for everyone
+        return await asyncio.shield(fut)
+
+
+_flights = SingleFlight()
+
+
+async def call_tool_coalesced(session: ClientSession, name: str, arguments: dict):
+    """session.call_tool(), sharing the in-flight call with identical concurrent requests."""
+    key = json.dumps({"tool": name, "args": arguments}, sort_keys=True)
+    return await _flights.do(key, lambda: session.call_tool(name, arguments=arguments))
+
+
+# Semantic cache 
+# Reworded prompts ("top 5 customers" / "show me the five best customers")
+# miss the exact cache, so prompts are also embedded and matched against
+# earlier ones by cosine similarity. The index is tied to a schema hash and
+# is reset whenever the schema changes.
+
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_THRESHOLD = 0.92
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache")
+# entries kept, least recently used dropped first (same bound as the exact cache)
+SEMANTIC_MAXSIZE = CACHE_MAXSIZE
+
+# "used" holds a last-use tick per entry, parallel to "sql"
+_semantic = {"model": None, "index": None, "sql": [], "used": [], "tick": 0, "schema_hash": None}
+
+
+def semantic_enabled() -> bool:
+    return faiss is not None and SentenceTransformer is not None
+
+
+def _schema_hash(schema: str) -> str:
+    return hashlib.sha256(schema.encode()).hexdigest()
+
+
+def schema_usable(schema: str) -> bool:
+    """False for an empty schema or a get_schema error message.
+
+    Such text would hash like a changed schema and reset the caches keyed on it.
+    """
+    return bool(schema) and not schema.startswith("Error")
+
+
+_embed_lock = threading.Lock()
+
+
+def _embed_model():
+    # loading takes seconds; callers on an event loop go through a thread (see
+    # embed_prompt), and the lock keeps concurrent threads from loading it twice
+    with _embed_lock:
+        if _semantic["model"] is None:
+            _semantic["model"] = SentenceTransformer(EMBED_MODEL_NAME)
+    return _semantic["model"]
+
+
+def embed_prompt(text: str):
+    """Return a normalized (1, dim) float32 embedding, so inner product == cosine.
+
+    Blocking (model load + CPU work): from async code call it via asyncio.to_thread.
+    """
+    return _embed_model().encode([text], normalize_embeddings=True).astype("float32")
+
+
+def new_semantic_index():
+    """Empty inner-product index sized for the embedding model."""
+    return faiss.IndexFlatIP(_embed_model().get_sentence_embedding_dimension())
+
+
+def _semantic_index(schema: str):
+    schema_hash = _schema_hash(schema)
+    if _semantic["index"] is None or _semantic["schema_hash"] != schema_hash:
+        _semantic["index"] = new_semantic_index()
+        _semantic["sql"] = []
+        _semantic["used"] = []
+        _semantic["schema_hash"] = schema_hash
+    return _semantic["index"]
+
+
+def _semantic_touch(i: int):
+    _semantic["tick"] += 1
+    _semantic["used"][i] = _semantic["tick"]
+
+
+def _semantic_trim(maxsize: int = SEMANTIC_MAXSIZE):
+    # the flat index can't drop single vectors, so rebuild it from the
+    # `maxsize` most recently used entries
+    index = _semantic["index"]
+    if index.ntotal <= maxsize:
+        return
+    keep = sorted(sorted(range(index.ntotal), key=_semantic["used"].__getitem__)[-maxsize:])
+    vectors = index.reconstruct_n(0, index.ntotal)
+    _semantic["index"] = faiss.IndexFlatIP(index.d)
+    _semantic["index"].add(vectors[keep])
+    _semantic["sql"] = [_semantic["sql"][i] for i in keep]
+    _semantic["used"] = [_semantic["used"][i] for i in keep]
+
+
+def _semantic_lookup(emb, schema: str) -> Optional[str]:
+    index = _semantic_index(schema)
+    if index.ntotal == 0:
+        return None
+    D, I = index.search(emb, 1)
+    if D[0, 0] >= SEMANTIC_THRESHOLD:
+        _semantic_touch(I[0, 0])
+        return _semantic["sql"][I[0, 0]]
+    return None
+
+
+def _semantic_add(emb, schema: str, sql: str):
+    _semantic_index(schema).add(emb)
+    _semantic["sql"].append(sql)
+    _semantic["used"].append(0)
+    _semantic_touch(len(_semantic["used"]) - 1)
+    _semantic_trim()
+
+
+def save_semantic_cache(path: str = SEMANTIC_CACHE_PATH):
+    """Write the semantic index and its SQL entries to disk.
+
+    Both files are written to temporary names first and then moved into
+    place, so a reader never sees a half-written file.
+    """
+    if not semantic_enabled() or _semantic["index"] is None:
+        return
+    faiss.write_index(_semantic["index"], path + ".index.tmp")
+    with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+        json.dump({
+            "schema_hash": _semantic["schema_hash"],
+            "ntotal": _semantic["index"].ntotal,
+            "maxsize": SEMANTIC_MAXSIZE,
+            "sql": _semantic["sql"],
+            "used": _semantic["used"],
+        }, f)
+    os.replace(path + ".index.tmp", path + ".index")
+    os.replace(path + ".json.tmp", path + ".json")
+
+
+def load_semantic_cache(path: str = SEMANTIC_CACHE_PATH):
+    """Load a previously saved semantic cache, if there is one.
+
+    A missing, unreadable or mismatched pair of files is ignored (the cache
+    just starts empty) rather than failing startup.
+    """
+    if not semantic_enabled():
+        return
+    if not (os.path.exists(path + ".index") and os.path.exists(path + ".json")):
+        return
+    try:
+        with open(path + ".json", encoding="utf-8") as f:
+            data = json.load(f)
+        index = faiss.read_index(path + ".index")
+        if not (index.ntotal == data["ntotal"] == len(data["sql"]) == len(data["used"])):
+            raise ValueError(f"index has {index.ntotal} entries, json has {len(data['sql'])}")
+    except Exception as e:
+        logger.warning("Ignoring saved semantic cache at %s: %s", path, e)
+        return
+    _semantic["index"] = index
+    _semantic["sql"] = data["sql"]
+    _semantic["used"] = data["used"]
+    _semantic["tick"] = max(data["used"], default=0)
+    _semantic["schema_hash"] = data["schema_hash"]
+    # saved under a larger SEMANTIC_MAXSIZE
+    if data.get("maxsize") != SEMANTIC_MAXSIZE:
+        _semantic_trim()
+
+
+def clear_semantic_cache(path: str = SEMANTIC_CACHE_PATH):
+    """Drop every semantic entry, in memory and on disk.
+
+    The saved files go too; otherwise the next startup would load the
+    cleared entries back.
+    """
+    _semantic["index"] = None
+    _semantic["sql"] = []
+    _semantic["used"] = []
+    _semantic["schema_hash"] = None
+    for suffix in (".index", ".json"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+# Requests that always map to the same SQL are answered without Gemini.
+# Patterns match the whole prompt so "list tables with more than 10 rows"
+# still goes to the model.
+_INTENTS = {
+    re.compile(r"^\s*(show|list)\s+(me\s+)?(all\s+)?(the\s+)?tables\W*$", re.I):
+        "SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_TYPE = 'BASE TABLE'",
+    re.compile(r"^\s*(what|which)\s+tables\s+(are\s+there|exist|do\s+(i|we)\s+have)\W*$", re.I):
+        "SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_TYPE = 'BASE TABLE'",
+    re.compile(r"^\s*how\s+many\s+tables(\s+(are\s+there|exist|do\s+(i|we)\s+have))?\W*$", re.I):
+        "SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_TYPE = 'BASE TABLE'",
+    re.compile(r"^\s*(show|list)\s+(me\s+)?(all\s+)?(the\s+)?views\W*$", re.I):
+        "SELECT TABLE_NAME FROM INFORMATION_SCHEMA.VIEWS",
+}
+_intent_stats = {"hits": 0}
+
+
+def _match_intent(user_prompt: str) -> Optional[str]:
+    for pattern, sql in _INTENTS.items():
+        if pattern.match(user_prompt):
+            _intent_stats["hits"] += 1
+            return sql
+    return None
+
+
+def intent_hits() -> int:
+    """Number of prompts answered by the canned intent router."""
+    return _intent_stats["hits"]
+
+
+# Schema compaction 
+# get_schema returns one "  - column (type) NULL|NOT NULL" line per column.
+# That is folded to one line per table, e.g. "Orders(id int!, note nvarchar)",
+# which carries the same information in far fewer prompt tokens.
+
+# column names may contain spaces, so the name is everything up to the last "(type)"
+_COLUMN_RE = re.compile(r"^\s*-\s*(.+?)\s+\(([^)]*)\)\s*(NOT NULL|NULL)?\s*$")
+_compact_schemas: dict[str, str] = {}
+
+
+def _compact_schema(schema_text: str) -> str:
+    """Compact schema text for prompts; cached per schema hash."""
+    schema_hash = _schema_hash(schema_text)
+    compact = _compact_schemas.get(schema_hash)
+    if compact is not None:
+        return compact
+
+    out: list[str] = []
+    table, columns = None, []
+
+    def _flush():
+        if table is not None:
+            out.append(f"{table}({', '.join(columns)})")
+
+    for line in schema_text.splitlines():
+        if not line.strip():
+            continue
+        if line.startswith("Table: "):
+            _flush()
+            table, columns = line[len("Table: "):].strip(), []
+            continue
+        m = _COLUMN_RE.match(line)
+        if m and table is not None:
+            name, data_type, nullable = m.groups()
+            if not re.fullmatch(r"\w+", name):
+                # bracket-quote so the model writes [Order Date]
+                name = f"[{name}]"
+            columns.append(f"{name} {data_type.strip()}" + ("!" if nullable == "NOT NULL" else ""))
+        else:
+            _flush()
+            table, columns = None, []
+            out.append(" ".join(line.split()))
+    _flush()
+
+    if any("!" in line for line in out):
+        out.append("(! = NOT NULL)")
+    compact = "\n".join(out)
+    # only the current schema matters
+    _compact_schemas.clear()
+    _compact_schemas[schema_hash] = compact
+    return compact
+
+
+# opening fence line (```, ```sql, ```tsql, ...) and closing ```, stripped in a single pass
+_FENCE_RE = re.compile(r"^```[\w-]*[ \t]*\n?|\n?```\s*$", re.MULTILINE)
+
+
+def _inline_schema(schema: str) -> str:
+    return f"Schema:\n{schema}\n\n"
+
+
+async def _sql_model_for(schema: str):
+    """Return (model, dynamic prompt prefix) to use for this schema.
+
+    Large schemas are moved into an explicit Gemini context cache, so the
+    per-request prompt only carries the user request. The cache is recreated
+    a few minutes before its TTL runs out.
+    """
+    if len(schema) // 4 < SCHEMA_CACHE_MIN_TOKENS:
+        return _sql_model, _inline_schema(schema)
+
+    schema_hash = _schema_hash(schema)
+    entry = _schema_models.get(schema_hash)
+    if entry is not None and time.monotonic() < entry[1]:
+        return entry[0], ""
+
+    async def _create():
+        try:
+            cached = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model=f"models/{MODEL_NAME}",
+                system_instruction=STATIC_SYSTEM,
+                contents=[f"Schema:\n{schema}"],
+                ttl=SCHEMA_CACHE_TTL,
+            )
+        except Exception as e:
+            logger.warning("Schema context cache unavailable, sending schema inline: %s", e)
+            return _sql_model, _inline_schema(schema)
+        model = genai.GenerativeModel.from_cached_content(cached_content=cached)
+        refresh_at = time.monotonic() + (SCHEMA_CACHE_TTL - SCHEMA_CACHE_REFRESH).total_seconds()
+        # only the current schema needs a handle; the replaced caches would
+        # otherwise stay billed on the server until their TTL runs out
+        old = list(_schema_models.values())
+        _schema_models.clear()
+        _schema_models[schema_hash] = (model, refresh_at, cached)
+        for _, _, old_cached in old:
+            try:
+                await asyncio.to_thread(old_cached.delete)
+            except Exception as e:
+                logger.warning("Could not delete old schema context cache: %s", e)
+        return model, ""
+
+    # different prompts on a cold schema share one upload
+    return await _flights.do("schema_cache:" + schema_hash, _create)
+
+
+# SQL validation 
+# Generated SQL is parsed locally before it is sent to the server, so malformed
+# or non-SELECT statements are rejected without a database round-trip.
+
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "0")) or None
+
+
+class SQLValidationError(ValueError):
+    pass
+
+
+def validate_sql(sql: str, max_rows: Optional[int] = SQL_MAX_ROWS) -> str:
+    """Check that `sql` is a single T-SQL query and return the SQL to run.
+
+    Anything other than a plain query (SELECT / set operations, no SELECT
+    INTO) is rejected. With `max_rows`, a SELECT without TOP gets one added;
+    otherwise the SQL is returned unchanged.
+    """
+    try:
+        statements = sqlglot.parse(sql, read="tsql")
+    except ParseError as e:
+        raise SQLValidationError(f"Invalid SQL: {e}") from e
+    statements = [s for s in statements if s is not None]
+    if len(statements) != 1:
+        raise SQLValidationError(f"Expected exactly one SQL statement, got {len(statements)}")
+
+    ast = statements[0]
+    if not isinstance(ast, (exp.Select, exp.Union, exp.Intersect, exp.Except)):
+        # a typo like "SELEC * FRM t" parses as a bare expression, not a statement
+        if isinstance(ast, (exp.Alias, exp.Condition)):
+            raise SQLValidationError("Invalid SQL: not a recognised statement")
+        raise SQLValidationError(f"Only SELECT queries are allowed, got {ast.key.upper()}")
+    if ast.args.get("into"):
+        raise SQLValidationError("SELECT INTO is not allowed")
+
+    if max_rows and isinstance(ast, exp.Select) and not ast.args.get("limit"):
+        return ast.limit(max_rows).sql(dialect="tsql")
     return sql
 
 
-async def summarise(user_prompt: str, sql: str, rows: str):
-    """Generate a natural language summary of the query results."""
-    prompt = f"""
+# function natural language to convert to sql query
+
+async def nl_to_sql(user_prompt: str, schema: str, cache_ttl: Optional[float] = None, emb=None):
+    """Convert natural language to MSSQL query using Gemini.
+
+    The returned SQL has passed validate_sql(); SQLValidationError is raised
+    otherwise. `emb` is an already computed prompt embedding for the semantic cache.
+    """
+    canned = _match_intent(user_prompt)
+    if canned is not None:
+        # canned SQL gets the same checks and SQL_MAX_ROWS limit as generated SQL
+        return validate_sql(canned)
+
+    key = _cache_key(user_prompt, schema, STATIC_SYSTEM)
+    cached = await _cache_get(key)
+    if cached is not None:
+        return cached
+
+    if not (semantic_enabled() and schema_usable(schema)):
+        emb = None
+    else:
+        if emb is None:
+            emb = await asyncio.to_thread(embed_prompt, user_prompt)
+        cached = _semantic_lookup(emb, schema)
+        if cached is not None:
+            await _cache_set(key, cached, cache_ttl)
+            return cached
+
+    async def _generate():
+        compact = _compact_schema(schema)
+        model, contents = await _sql_model_for(compact)
+        try:
+            response = await model.generate_content_async(contents + f"User request: {user_prompt}")
+        except (google_exceptions.NotFound, google_exceptions.PermissionDenied) as e:
+            if contents:
+                raise
+            # the context cache expired or was deleted server-side
+            logger.warning("Schema context cache gone, sending schema inline: %s", e)
+            _schema_models.pop(_schema_hash(compact), None)
+            response = await _sql_model.generate_content_async(
+                _inline_schema(compact) + f"User request: {user_prompt}"
+            )
+
+        # Clean up any markdown code blocks if present
+        sql = _FENCE_RE.sub("", response.text.strip()).strip()
+
+        # validate before caching, so a bad answer isn't replayed on every retry
+        try:
+            sql = validate_sql(sql)
+        except SQLValidationError as e:
+            raise SQLValidationError(f"{e} (generated SQL: {sql})") from e
+
+        await _cache_set(key, sql, cache_ttl)
+        if emb is not None:
+            _semantic_add(emb, schema, sql)
+        return sql
+
+    # identical prompts arriving together share one Gemini call
+    return await _flights.do("nl_to_sql:" + key, _generate)
+
+
+def parse_tabular(text: str) -> tuple[list[str], list[list[str]]]:
+    """Parse execute_sql output (header line + comma-joined rows) once into header and rows.
+
+    The server joins values with a bare "," and rows with "\n", without any
+    quoting, so this is a plain split; "\r" inside values is kept as data.
+    """
+    if not text:
+        return [], []
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines[0].split(","), [line.split(",") for line in lines[1:]]
+
+
+def tabular_text(header: list[str], rows: list[list[str]]) -> str:
+    """Inverse of parse_tabular(), e.g. for putting a few rows into a prompt."""
+    return "\n".join(",".join(row) for row in [header, *rows])
+
+
+def _summary_prompt(user_prompt: str, sql: str, rows: str) -> str:
+    return f"""
 User asked: {user_prompt}
 
 SQL Executed:
@@ -69,8 +729,68 @@ Provide a clear, concise summary for the user. Include:
 Keep it natural and conversational.
 """
 
-    response = genai.GenerativeModel("gemini-2.5-flash").generate_content(prompt)
-    return response.text.strip()
+
+async def summarise(user_prompt: str, sql: str, rows: str, cache_ttl: Optional[float] = None):
+    """Generate a natural language summary of the query results."""
+    prompt = _summary_prompt(user_prompt, sql, rows)
+
+    key = _cache_key(prompt)
+    cached = await _cache_get(key)
+    if cached is not None:
+        return cached
+
+    response = await _model.generate_content_async(prompt)
+    summary = response.text.strip()
+    await _cache_set(key, summary, cache_ttl)
+    return summary
+
+
+async def summarise_stream(user_prompt: str, sql: str, rows: str, cache_ttl: Optional[float] = None):
+    """Like summarise(), but yields the summary text chunk by chunk as Gemini produces it.
+
+    A cached summary is yielded as a single chunk; on a miss the chunks are
+    accumulated and the full text is cached once the stream completes.
+    """
+    prompt = _summary_prompt(user_prompt, sql, rows)
+
+    key = _cache_key(prompt)
+    cached = await _cache_get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    parts = []
+    response = await _model.generate_content_async(prompt, stream=True)
+    async for chunk in response:
+        if chunk.text:
+            parts.append(chunk.text)
+            yield chunk.text
+    await _cache_set(key, "".join(parts).strip(), cache_ttl)
+
+
+async def _ainput(prompt: str) -> str:
+    """input() on a daemon thread, so the event loop keeps serving MCP messages.
+
+    A daemon thread (rather than the default executor) means Ctrl+C doesn't
+    leave asyncio.run() waiting on a thread stuck in input().
+    """
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def _settle(setter, value):
+        if not fut.done():
+            setter(value)
+
+    def _read():
+        try:
+            line = input(prompt)
+        except Exception as e:
+            loop.call_soon_threadsafe(_settle, fut.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(_settle, fut.set_result, line)
+
+    threading.Thread(target=_read, daemon=True).start()
+    return await fut
 
 
 async def run_pipeline(session: ClientSession):
@@ -81,7 +801,7 @@ async def run_pipeline(session: ClientSession):
 
     # Get schema once at the start
     print("📋 Fetching database schema...")
-    schema_result = await session.call_tool("get_schema", arguments={})
+    schema_result = await call_tool_coalesced(session, "get_schema", {})
     schema_text = schema_result.content[0].text
     print("✅ Schema retrieved\n")
     print("=" * 60)
@@ -89,7 +809,7 @@ async def run_pipeline(session: ClientSession):
     while True:
         try:
             # Get user input
-            user_prompt = input("\n💬 Enter your question: ").strip()
+            user_prompt = (await _ainput("\n💬 Enter your question: ")).strip()
 
             # Check for exit commands
             if user_prompt.lower() in ['exit', 'quit', 'q', '']:
@@ -98,7 +818,11 @@ async def run_pipeline(session: ClientSession):
 
             # 2. Convert NL → SQL using Gemini
             print("\n🤖 Converting to SQL...")
-            sql_query = await nl_to_sql(user_prompt, schema_text)
+            try:
+                sql_query = await nl_to_sql(user_prompt, schema_text)
+            except SQLValidationError as e:
+                print(f"\n❌ {e}")
+                continue
             print(f"\n📝 Generated SQL:\n{sql_query}\n")
 
             # 3. Execute SQL on MCP server
@@ -114,8 +838,8 @@ async def run_pipeline(session: ClientSession):
             print("✅ Query executed successfully")
 
             # Get only top 10 rows + header for summary
-            lines = sql_output.splitlines()
-            rows_text = "\n".join(lines[:11]) if len(lines) > 11 else sql_output
+            header, rows = parse_tabular(sql_output)
+            rows_text = tabular_text(header, rows[:10])
 
             # 4. Generate final answer from LLM
             print("\n🧠 Generating summary...\n")
@@ -126,7 +850,7 @@ async def run_pipeline(session: ClientSession):
             print("=" * 60)
             print(answer)
             print("=" * 60)
-            print(f"\n📊 Total rows returned: {len(lines) - 1}")  # -1 for header
+            print(f"\n📊 Total rows returned: {len(rows)}")
             print("=" * 60)
 
         except KeyboardInterrupt:
@@ -179,8 +903,16 @@ async def main():
         print("   - MSSQL_PASSWORD")
         print("   - MSSQL_DATABASE")
         import traceback
-        traceback.print_exc()
+        await asyncio.to_thread(traceback.print_exception, type(e), e, e.__traceback__)
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """uvloop's event loop when it is installed, else the default asyncio loop."""
+    return uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -40,9 +40,16 @@ def get_db_config():
 # Initialize server
 app = Server("mssql_mcp_server")
 
+# pyodbc calls block, so every handler runs its DB work in a worker thread;
+# otherwise concurrent requests (e.g. from several API workers over SSE) would
+# be served one at a time on the event loop.
+
 @app.list_resources()
 async def list_resources() -> list[Resource]:
     """List MSSQL tables as resources."""
+    return await asyncio.to_thread(_list_resources)
+
+def _list_resources() -> list[Resource]:
     config, connection_string = get_db_config()
     try:
         with connect(connection_string) as conn:
@@ -70,6 +77,9 @@ async def list_resources() -> list[Resource]:
 @app.read_resource()
 async def read_resource(uri: AnyUrl) -> str:
     """Read table contents."""
+    return await asyncio.to_thread(_read_resource, uri)
+
+def _read_resource(uri: AnyUrl) -> str:
     config, connection_string = get_db_config()
     uri_str = str(uri)
     logger.info(f"Reading resource: {uri_str}")
@@ -131,91 +141,127 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
     logger.info(f"Calling tool: {name} with arguments: {arguments}")
     
     if name == "get_schema":
-        try:
-            with connect(connection_string) as conn:
-                with conn.cursor() as cursor:
-                    # Get all tables and their columns
-                    cursor.execute("""
-                        SELECT 
-                            t.TABLE_NAME,
-                            c.COLUMN_NAME,
-                            c.DATA_TYPE,
-                            c.IS_NULLABLE
-                        FROM INFORMATION_SCHEMA.TABLES t
-                        INNER JOIN INFORMATION_SCHEMA.COLUMNS c 
-                            ON t.TABLE_NAME = c.TABLE_NAME
-                        WHERE t.TABLE_TYPE = 'BASE TABLE'
-                        ORDER BY t.TABLE_NAME, c.ORDINAL_POSITION
-                    """)
-                    
-                    rows = cursor.fetchall()
-                    
-                    # Format schema
-                    schema_text = f"Database: {config['database']}\n\n"
-                    current_table = None
-                    
-                    for row in rows:
-                        table_name, column_name, data_type, is_nullable = row
-                        
-                        if table_name != current_table:
-                            if current_table is not None:
-                                schema_text += "\n"
-                            schema_text += f"Table: {table_name}\n"
-                            current_table = table_name
-                        
-                        nullable = "NULL" if is_nullable == "YES" else "NOT NULL"
-                        schema_text += f"  - {column_name} ({data_type}) {nullable}\n"
-                    
-                    return [TextContent(type="text", text=schema_text)]
-                    
-        except Exception as e:
-            logger.error(f"Error getting schema: {e}")
-            return [TextContent(type="text", text=f"Error getting schema: {str(e)}")]
+        return await asyncio.to_thread(_get_schema, config, connection_string)
     
     elif name == "execute_sql":
         query = arguments.get("query")
         if not query:
             raise ValueError("Query is required")
-        
-        try:
-            with connect(connection_string) as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute(query)
-                    
-                    # Special handling for listing tables in MSSQL
-                    if query.strip().upper() == "SHOW TABLES":
-                        cursor.execute("SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_TYPE = 'BASE TABLE';")
-                        tables = cursor.fetchall()
-                        result = [f"Tables_in_{config['database']}"]  # Header
-                        result.extend([table[0] for table in tables])
-                        return [TextContent(type="text", text="\n".join(result))]
-                    
-                    # Regular SELECT queries
-                    elif query.strip().upper().startswith("SELECT"):
-                        columns = [desc[0] for desc in cursor.description]
-                        rows = cursor.fetchall()
-                        result = [",".join(map(str, row)) for row in rows]
-                        return [TextContent(type="text", text="\n".join([",".join(columns)] + result))]
-                    
-                    # Non-SELECT queries
-                    else:
-                        conn.commit()
-                        return [TextContent(type="text", text=f"Query executed successfully. Rows affected: {cursor.rowcount}")]
-                    
-        except Exception as e:
-            logger.error(f"Error executing SQL '{query}': {e}")
-            return [TextContent(type="text", text=f"Error executing query: {str(e)}")]
+        return await asyncio.to_thread(_execute_sql, config, connection_string, query)
     
     else:
         raise ValueError(f"Unknown tool: {name}")
 
-async def main():
+def _get_schema(config: dict, connection_string: str) -> list[TextContent]:
+    try:
+        with connect(connection_string) as conn:
+            with conn.cursor() as cursor:
+                # Get all tables and their columns
+                cursor.execute("""
+                    SELECT 
+                        t.TABLE_NAME,
+                        c.COLUMN_NAME,
+                        c.DATA_TYPE,
+                        c.IS_NULLABLE
+                    FROM INFORMATION_SCHEMA.TABLES t
+                    INNER JOIN INFORMATION_SCHEMA.COLUMNS c 
+                        ON t.TABLE_NAME = c.TABLE_NAME
+                    WHERE t.TABLE_TYPE = 'BASE TABLE'
+                    ORDER BY t.TABLE_NAME, c.ORDINAL_POSITION
+                """)
+                
+                rows = cursor.fetchall()
+                
+                # Format schema
+                schema_text = f"Database: {config['database']}\n\n"
+                current_table = None
+                
+                for row in rows:
+                    table_name, column_name, data_type, is_nullable = row
+                    
+                    if table_name != current_table:
+                        if current_table is not None:
+                            schema_text += "\n"
+                        schema_text += f"Table: {table_name}\n"
+                        current_table = table_name
+                    
+                    nullable = "NULL" if is_nullable == "YES" else "NOT NULL"
+                    schema_text += f"  - {column_name} ({data_type}) {nullable}\n"
+                
+                return [TextContent(type="text", text=schema_text)]
+                
+    except Exception as e:
+        logger.error(f"Error getting schema: {e}")
+        return [TextContent(type="text", text=f"Error getting schema: {str(e)}")]
+
+def _execute_sql(config: dict, connection_string: str, query: str) -> list[TextContent]:
+    try:
+        with connect(connection_string) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query)
+                
+                # Special handling for listing tables in MSSQL
+                if query.strip().upper() == "SHOW TABLES":
+                    cursor.execute("SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_TYPE = 'BASE TABLE';")
+                    tables = cursor.fetchall()
+                    result = [f"Tables_in_{config['database']}"]  # Header
+                    result.extend([table[0] for table in tables])
+                    return [TextContent(type="text", text="\n".join(result))]
+                
+                # Regular SELECT queries
+                elif query.strip().upper().startswith("SELECT"):
+                    columns = [desc[0] for desc in cursor.description]
+                    rows = cursor.fetchall()
+                    result = [",".join(map(str, row)) for row in rows]
+                    return [TextContent(type="text", text="\n".join([",".join(columns)] + result))]
+                
+                # Non-SELECT queries
+                else:
+                    conn.commit()
+                    return [TextContent(type="text", text=f"Query executed successfully. Rows affected: {cursor.rowcount}")]
+                
+    except Exception as e:
+        logger.error(f"Error executing SQL '{query}': {e}")
+        return [TextContent(type="text", text=f"Error executing query: {str(e)}")]
+
+async def run_sse(host: str, port: int):
+    """Serve MCP over SSE so several clients (e.g. API workers) share one server."""
+    import uvicorn
+    from mcp.server.sse import SseServerTransport
+    from starlette.applications import Starlette
+    from starlette.responses import Response
+    from starlette.routing import Mount, Route
+
+    sse = SseServerTransport("/messages/")
+
+    async def handle_sse(request):
+        async with sse.connect_sse(request.scope, request.receive, request._send) as (read_stream, write_stream):
+            await app.run(
+                read_stream,
+                write_stream,
+                app.create_initialization_options()
+            )
+        return Response()
+
+    starlette_app = Starlette(routes=[
+        Route("/sse", endpoint=handle_sse),
+        Mount("/messages/", app=sse.handle_post_message),
+    ])
+    await uvicorn.Server(uvicorn.Config(starlette_app, host=host, port=port)).serve()
+
+
+async def main(transport: str = "stdio", host: str = "127.0.0.1", port: int = 8001):
     """Main entry point to run the MCP server."""
     from mcp.server.stdio import stdio_server
     
     logger.info("Starting MSSQL MCP server...")
     config, _ = get_db_config()
     logger.info(f"Database config: {config['server']}/{config['database']} as {config['user']}")
+
+    if transport == "sse":
+        logger.info(f"Serving MCP over SSE on http://{host}:{port}/sse")
+        await run_sse(host, port)
+        return
     
     async with stdio_server() as (read_stream, write_stream):
         try:
@@ -229,4 +275,11 @@ async def main():
             raise
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="MSSQL MCP server")
+    parser.add_argument("--transport", choices=["stdio", "sse"], default="stdio")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+    asyncio.run(main(args.transport, args.host, args.port))
\ No newline at end of file
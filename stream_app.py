@@ -1,10 +1,17 @@
 import streamlit as st
 import asyncio
+import concurrent.futures
+import threading
+
+import anyio
 from mcp import ClientSession
 from mcp.client.stdio import stdio_client, StdioServerParameters
 
 
-from main_client import nl_to_sql, summarise
+from main_client import (
+    nl_to_sql, summarise, get_cache, parse_tabular, tabular_text, call_tool_coalesced, new_event_loop,
+    clear_semantic_cache,
+)
 
 st.set_page_config(page_title="SQL CHAT BOT", page_icon="🗄️")
 st.title("SQL Chatbot")
@@ -19,58 +26,157 @@ col1, col2 = st.columns([1, 1.5])
 with col2:
     send = st.button("Send")
 
-async def _run_pipeline_once(user_prompt: str):
-    server_params = StdioServerParameters(
-        command="python",
-        args=["server.py"]
-    )
-
-    try:
-        async with stdio_client(server_params) as (read, write):
-            async with ClientSession(read, write) as session:
-                await session.initialize()
-
-                # 1) Get schema
-                schema_resp = await session.call_tool("get_schema", arguments={})
-                schema_text = schema_resp.content[0].text
+SESSION_START_TIMEOUT = 60
+# raised by the MCP streams once server.py has gone away
+_CLOSED_ERRORS = (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream)
+
+
+@st.cache_resource
+def _session_lock():
+    # cached so every script rerun sees the same lock
+    return threading.Lock()
+
+
+@st.cache_resource
+def get_loop():
+    """Background event loop shared by the MCP session and the response cache."""
+    loop = new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+@st.cache_resource
+def get_session():
+    """Start one MCP ClientSession on the background loop and reuse it across reruns.
+
+    Spawning server.py and doing the MCP handshake on every click costs far more
+    than the query itself, so the session is kept until server.py goes away.
+    Returns {"session", "runner", "dead"}; `dead` is set once the runner exits.
+    """
+    with _session_lock():
+        loop = get_loop()
+        ready = concurrent.futures.Future()
+        dead = threading.Event()
+
+        async def _client_runner():
+            server_params = StdioServerParameters(
+                command="python",
+                args=["server.py"]
+            )
+            try:
+                async with stdio_client(server_params) as (read, write):
+                    async with ClientSession(read, write) as session:
+                        await session.initialize()
+                        ready.set_result(session)
+                        # keep running until cancelled or server.py exits
+                        await asyncio.Future()
+            except Exception as e:
+                if not ready.done():
+                    ready.set_exception(e)
+
+        async def _start():
+            task = asyncio.ensure_future(_client_runner())
+            task.add_done_callback(lambda _: dead.set())
+            return task
+
+        runner = asyncio.run_coroutine_threadsafe(_start(), loop).result()
+        try:
+            session = ready.result(timeout=SESSION_START_TIMEOUT)
+        except BaseException:
+            # cancelling the runner exits stdio_client, which terminates server.py
+            loop.call_soon_threadsafe(runner.cancel)
+            raise
+        return {"session": session, "runner": runner, "dead": dead}
 
-                # 2) NL -> SQL
-                sql = await nl_to_sql(user_prompt, schema_text)
 
-                # 3) Execute SQL
-                exec_resp = await session.call_tool("execute_sql", arguments={"query": sql})
-                output = exec_resp.content[0].text
+def _drop_session(mcp: dict):
+    get_session.clear()
+    if not mcp["dead"].is_set():
+        get_loop().call_soon_threadsafe(mcp["runner"].cancel)
 
-                # 4) Summarize (use up to first 10 rows + header)
-                lines = output.splitlines()
-                rows_text = "\n".join(lines[:11]) if len(lines) > 11 else output
-                summary = await summarise(user_prompt, sql, rows_text)
 
-                return {"sql": sql, "output": output, "summary": summary}
+def _run_on_session(coro_factory):
+    """Run coro_factory(session) on the background loop.
 
+    If server.py died (before or during the call) the cached session is
+    dropped and the call is retried once on a fresh one.
+    """
+    for _ in range(2):
+        try:
+            mcp = get_session()
+        except Exception:
+            # don't keep a failed start around, retry on the next click
+            get_session.clear()
+            raise
+        if mcp["dead"].is_set():
+            _drop_session(mcp)
+            continue
+
+        fut = asyncio.run_coroutine_threadsafe(coro_factory(mcp["session"]), get_loop())
+        while True:
+            done, _ = concurrent.futures.wait([fut], timeout=0.5)
+            if done:
+                try:
+                    return fut.result()
+                except _CLOSED_ERRORS:
+                    break
+            if mcp["dead"].is_set():
+                break
+        fut.cancel()
+        _drop_session(mcp)
+    raise RuntimeError("Lost connection to the MCP server")
+
+
+async def _pipeline(session: ClientSession, user_prompt: str):
+    # 1) Get schema
+    schema_resp = await call_tool_coalesced(session, "get_schema", {})
+    schema_text = schema_resp.content[0].text
+
+    # 2) NL -> SQL
+    sql = await nl_to_sql(user_prompt, schema_text)
+
+    # 3) Execute SQL
+    exec_resp = await session.call_tool("execute_sql", arguments={"query": sql})
+    output = exec_resp.content[0].text
+
+    # 4) Summarize (use up to first 10 rows + header)
+    header, rows = parse_tabular(output)
+    rows_text = tabular_text(header, rows[:10])
+    summary = await summarise(user_prompt, sql, rows_text)
+
+    return {"sql": sql, "output": output, "row_count": len(rows), "summary": summary}
+
+
+def _run_pipeline_once(user_prompt: str):
+    try:
+        return _run_on_session(lambda session: _pipeline(session, user_prompt))
     except Exception as e:
         return {"error": str(e)}
 
+# the response cache is shared with the API when REDIS_URL is set
+with st.sidebar:
+    st.caption(f"Response cache: {get_cache().name}")
+    if st.button("Clear cache"):
+        # runs on the shared loop (a Redis client is bound to it), no MCP session needed
+        try:
+            asyncio.run_coroutine_threadsafe(get_cache().clear(), get_loop()).result()
+            clear_semantic_cache()
+        except Exception as e:
+            st.error(f"Clearing the cache failed: {e}")
+
 # trigger pipline on buttton
 
 if send and prompt:
     st.session_state["history"].append({"role": "user", "text": prompt})
     with st.spinner("Processing..."):
-        try:
-            result = asyncio.run(_run_pipeline_once(prompt))
-
-        except RuntimeError:
-
-            loop = asyncio.new_event_loop()
-            result = loop.run_until_complete(_run_pipeline_once(prompt))
-            loop.close()
+        result = _run_pipeline_once(prompt)
 
     if result is None:
         st.session_state["history"].append({"role": "assistant", "text": "No response (internal error)."})
     elif "error" in result:
         st.session_state["history"].append({"role": "assistant", "text": f"Error: {result['error']}"})
     else:
-        assistant_msg = f"SQL:\n{result['sql']}\n\nResults:\n{result['output']}\n\nSummary:\n{result['summary']}"
+        assistant_msg = f"SQL:\n{result['sql']}\n\nResults ({result['row_count']} rows):\n{result['output']}\n\nSummary:\n{result['summary']}"
         st.session_state["history"].append({"role": "assistant", "text": assistant_msg})
 
 for item in st.session_state["history"]:
@@ -0,0 +1,15 @@
+import main_client
+
+
+def test_parse_tabular_keeps_carriage_returns_in_values():
+    # CRLF inside NVARCHAR values used to break csv.reader
+    header, rows = main_client.parse_tabular("id,note\n1,a\rb\n2,c")
+    assert header == ["id", "note"]
+    assert rows == [["1", "a\rb"], ["2", "c"]]
+
+
+def test_parse_tabular_round_trips_server_output():
+    text = "id,name\n1,alice\n2,bob"
+    header, rows = main_client.parse_tabular(text)
+    assert len(rows) == 2
+    assert main_client.tabular_text(header, rows) == text